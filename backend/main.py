@@ -1,7 +1,9 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
+import asyncio
 import os
 import uuid
 from pathlib import Path
@@ -17,18 +19,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="AI Note Scanner API")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["chrome-extension://*", "http://localhost:*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
 
 pdf_parser = PDFParser()
 embedding_service = EmbeddingService()
@@ -36,7 +29,25 @@ vector_store = VectorStore()
 alignment_service = AlignmentService(embedding_service, vector_store)
 concept_detector = ConceptDetector(embedding_service, vector_store)
 misconception_detector = MisconceptionDetector(embedding_service, vector_store)
-quiz_generator = QuizGenerator()
+quiz_generator = QuizGenerator(embedding_service)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the embedding model once at startup instead of on the first request
+    await asyncio.to_thread(embedding_service.warmup)
+    yield
+
+
+app = FastAPI(title="AI Note Scanner API", lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["chrome-extension://*", "http://localhost:*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 
 class ScanNotesRequest(BaseModel):
@@ -57,22 +68,26 @@ async def upload_slides(file: UploadFile = File(...)):
         file_id = str(uuid.uuid4())
         file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
         
+        # Stream the upload to disk instead of buffering the whole PDF in memory
         with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
         
         slides = await pdf_parser.parse(file_path)
         
-        slide_embeddings = []
-        for i, slide_text in enumerate(slides):
-            embedding = embedding_service.embed(slide_text)
-            slide_embeddings.append({
+        # Encode the deck in a worker thread so other requests keep being served
+        embeddings = await asyncio.to_thread(embedding_service.embed_batch, slides)
+        slide_embeddings = [
+            {
                 "slide_index": i,
                 "text": slide_text,
                 "embedding": embedding
-            })
+            }
+            for i, (slide_text, embedding) in enumerate(zip(slides, embeddings))
+        ]
         
         vector_store.add_slides(file_id, slide_embeddings)
+        alignment_service.add_slides(file_id, embeddings)
         
         return {
             "slide_id": file_id,
@@ -90,20 +105,23 @@ async def scan_notes(request: ScanNotesRequest):
         if not slide_data:
             raise HTTPException(status_code=404, detail="Slides not found")
         
-        notes_embedding = embedding_service.embed(request.notes_text)
+        notes_embedding = await embedding_service.aembed(request.notes_text, persist=False)
         covered_slides = alignment_service.find_covered_slides(
             request.slide_id,
-            notes_embedding
+            notes_embedding,
+            slide_data
         )
         
         covered_slide_data = slide_data[:min(covered_slides + 1, len(slide_data))]
         
-        misconceptions = misconception_detector.detect(
+        misconceptions = await misconception_detector.detect(
             request.notes_text,
             covered_slide_data
         )
         
-        question = quiz_generator.generate_single(covered_slide_data, previous_questions=None)
+        question = await asyncio.to_thread(
+            quiz_generator.generate_single, covered_slide_data, previous_questions=None
+        )
         
         return {
             "question": question,
@@ -122,16 +140,18 @@ async def refresh_question(request: RefreshQuestionRequest):
         if not slide_data:
             raise HTTPException(status_code=404, detail="Slides not found")
         
-        notes_embedding = embedding_service.embed(request.notes_text)
+        notes_embedding = await embedding_service.aembed(request.notes_text, persist=False)
         covered_slides = alignment_service.find_covered_slides(
             request.slide_id,
-            notes_embedding
+            notes_embedding,
+            slide_data
         )
         
         covered_slide_data = slide_data[:min(covered_slides + 1, len(slide_data))]
         
-        question = quiz_generator.generate_single(
-            covered_slide_data, 
+        question = await asyncio.to_thread(
+            quiz_generator.generate_single,
+            covered_slide_data,
             previous_questions=request.previous_questions or []
         )
         
@@ -2,7 +2,7 @@
 Semantic alignment service to determine lecture progress
 """
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Optional
 from .embedding_service import EmbeddingService
 from storage.vector_store import VectorStore
 
@@ -14,66 +14,91 @@ class AlignmentService:
         self.embedding_service = embedding_service
         self.vector_store = vector_store
         self.similarity_threshold = 0.3  # Minimum similarity to consider slide "covered"
+        # Slides never change after upload, so cache one contiguous (N, 384) matrix per deck
+        self._slide_matrices: Dict[str, np.ndarray] = {}
     
-    def find_covered_slides(self, slide_id: str, notes_embedding: np.ndarray) -> int:
+    def add_slides(self, slide_id: str, embeddings_matrix: np.ndarray) -> None:
+        """
+        Register a deck's (N, 384) embedding matrix as returned by embed_batch
+        
+        Slide records in the vector store hold row views of this same matrix,
+        so alignment scans one contiguous block instead of N separate arrays
+        """
+        self._slide_matrices[slide_id] = np.ascontiguousarray(embeddings_matrix, dtype=np.float32)
+    
+    def get_embedding_matrix(self, slide_id: str, slide_data: List[Dict]) -> np.ndarray:
+        """
+        Return the embedding matrix (unit-length rows) for a slide deck
+        
+        Decks not registered through add_slides (e.g. loaded into the vector
+        store elsewhere) are stacked from their slide records once and cached
+        """
+        matrix = self._slide_matrices.get(slide_id)
+        if matrix is None or matrix.shape[0] != len(slide_data):
+            matrix = np.ascontiguousarray(
+                np.stack([slide['embedding'] for slide in slide_data]), dtype=np.float32
+            )
+            self._slide_matrices[slide_id] = matrix
+        return matrix
+    
+    def _slide_similarities(self, slide_id: str, slide_data: List[Dict], embeddings: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every slide against one embedding (N,) or several (N, M)"""
+        return self.get_embedding_matrix(slide_id, slide_data) @ embeddings.T
+    
+    def find_covered_slides(
+        self,
+        slide_id: str,
+        notes_embedding: np.ndarray,
+        slide_data: Optional[List[Dict]] = None
+    ) -> int:
         """
         Find the highest slide index that has been covered
         
+        Args:
+            slide_data: Slides already fetched from the vector store, if the
+                caller has them; skips a second lookup
+        
         Returns:
             Index of last covered slide (0-indexed)
         """
-        slide_data = self.vector_store.get_slides(slide_id)
+        if slide_data is None:
+            slide_data = self.vector_store.get_slides(slide_id)
         if not slide_data:
             return 0
         
-        # Compute similarity between notes and each slide
-        similarities = []
-        for slide in slide_data:
-            slide_embedding = slide['embedding']
-            similarity = self.embedding_service.similarity(notes_embedding, slide_embedding)
-            similarities.append(similarity)
-        
-        # Find the highest cumulative similarity region
-        # Use a sliding window approach
-        max_cumulative = 0
-        best_index = 0
+        # Cosine similarity against every slide in a single matrix-vector product
+        similarities = self._slide_similarities(slide_id, slide_data, notes_embedding)
         
-        # Check cumulative similarity up to each slide
-        for i in range(len(similarities)):
-            cumulative = sum(similarities[:i+1])
-            if cumulative > max_cumulative:
-                max_cumulative = cumulative
-                best_index = i
+        # Find the highest cumulative similarity region (first index at the maximum)
+        cumulative = np.cumsum(similarities)
+        best_index = int(np.argmax(cumulative)) if cumulative.max() > 0 else 0
         
         # Also check if individual slides exceed threshold
-        for i, sim in enumerate(similarities):
-            if sim > self.similarity_threshold:
-                best_index = max(best_index, i)
+        above_threshold = np.flatnonzero(similarities > self.similarity_threshold)
+        if above_threshold.size:
+            best_index = max(best_index, int(above_threshold[-1]))
         
         return best_index
     
-    def compute_similarity_matrix(self, slide_id: str, notes_chunks: List[str]) -> np.ndarray:
+    def compute_similarity_matrix(
+        self,
+        slide_id: str,
+        notes_chunks: List[str],
+        slide_data: Optional[List[Dict]] = None
+    ) -> np.ndarray:
         """
         Compute similarity matrix between lecture slides and note chunks
         
         Returns:
             Matrix of shape (num_slides, num_note_chunks)
         """
-        slide_data = self.vector_store.get_slides(slide_id)
+        if slide_data is None:
+            slide_data = self.vector_store.get_slides(slide_id)
         if not slide_data:
             return np.array([])
         
         # Embed note chunks
-        note_embeddings = self.embedding_service.embed_batch(notes_chunks)
+        note_embeddings = self.embedding_service.embed_batch(notes_chunks, persist=False)
         
-        # Compute similarity matrix
-        similarity_matrix = np.zeros((len(slide_data), len(notes_chunks)))
-        
-        for i, slide in enumerate(slide_data):
-            slide_embedding = slide['embedding']
-            for j, note_embedding in enumerate(note_embeddings):
-                similarity = self.embedding_service.similarity(slide_embedding, note_embedding)
-                similarity_matrix[i, j] = similarity
-        
-        return similarity_matrix
-
+        # Compute similarity matrix in one matrix product
+        return self._slide_similarities(slide_id, slide_data, note_embeddings)
@@ -1,16 +1,134 @@
 """
 Concept extraction and gap detection service
 """
-import json
+import asyncio
+import hashlib
+import heapq
 import os
 import re
+from collections import OrderedDict
 from typing import Dict, List, Set
 
-from openai import OpenAI
+import numpy as np
+import orjson
+from openai import AsyncOpenAI
+
+try:
+    import hyperscan
+except ImportError:  # Optional: without it the compiled re patterns below are used directly.
+    hyperscan = None
 
 from .embedding_service import EmbeddingService
+from .llm_limits import llm_semaphore
 from storage.vector_store import VectorStore
 
+# Patterns are compiled once at import; they run per sentence / per concept.
+_SENTENCE_SPLIT = re.compile(r"[.!?]\s+")
+_NUMBER_FACT = re.compile(
+    r"(\b[\w\s]{0,40}(?:ranges?|range|from|between|within)\s+\d+(?:\s*[-–]\s*\d+)?(?:\s+\w+)*)",
+    re.IGNORECASE,
+)
+_DATA_SOURCE = re.compile(r"data\s+from\s+(\d+\s+\w+(?:\s+\w+){0,6})", re.IGNORECASE)
+_PREDICTION = re.compile(r"predicts?\s+([^,\.]+(?:\([^)]+\))?)", re.IGNORECASE)
+_DEFINITION = re.compile(r"\b([A-Z][A-Z]+)\s+stands?\s+for\s+([^,\.]+)")
+_CAPABILITY = re.compile(
+    r"\b(?:uses?|includes?|provides?|offers?|relies\s+on)\s+([^,\.]+)", re.IGNORECASE
+)
+_LEADING_NUMBERING = re.compile(r"^[\d\.\)\-]+\s*")
+_DIGIT = re.compile(r"\d")
+_CAPITALIZED_WORD = re.compile(r"\b[A-Z][a-z]+\b")
+_MEANINGFUL_WORD = re.compile(r"[A-Za-z]{3,}")
+# Bullet artifacts and slide furniture, matched against the lowercased concept.
+_NOISE_PATTERNS = [
+    r"[•▪◦]",
+    r"--",
+    r"___",
+    r"\bslide\b",
+    r"\bpage\b",
+    r"\bfigure\b",
+    r"\btable\b",
+    r"\buniversity\b",
+    r"\bdepartment\b",
+]
+_NOISE = re.compile("|".join(_NOISE_PATTERNS))
+# Fallback extraction families, in the order _extract_from_text_fallback checks them.
+_FALLBACK_FAMILIES = (_NUMBER_FACT, _DATA_SOURCE, _PREDICTION, _DEFINITION, _CAPABILITY)
+_STOP_WORDS = frozenset(
+    {
+        "the",
+        "and",
+        "or",
+        "but",
+        "in",
+        "on",
+        "at",
+        "to",
+        "for",
+        "of",
+        "with",
+        "by",
+        "a",
+        "an",
+        "is",
+        "are",
+        "was",
+        "were",
+    }
+)
+
+
+def _compile_hyperscan(patterns: List[re.Pattern]):
+    """
+    Compile patterns into one Hyperscan prefilter database, or None if unavailable.
+
+    UCP makes \w, \d and \s Unicode-aware like Python's re on str. Hyperscan
+    rejects \b in UCP mode, so the database is built in prefilter mode, which
+    relaxes such assertions and reports a superset of the re matches; callers
+    confirm hits with the re pattern.
+    """
+    if hyperscan is None:
+        return None
+    try:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[pattern.pattern.encode("utf-8") for pattern in patterns],
+            ids=list(range(len(patterns))),
+            flags=[
+                hyperscan.HS_FLAG_UTF8
+                | hyperscan.HS_FLAG_UCP
+                | hyperscan.HS_FLAG_PREFILTER
+                | hyperscan.HS_FLAG_SINGLEMATCH
+                | (hyperscan.HS_FLAG_CASELESS if pattern.flags & re.IGNORECASE else 0)
+                for pattern in patterns
+            ],
+        )
+        return db
+    except Exception:
+        return None
+
+
+def _hyperscan_matches(db, text: str) -> Set[int]:
+    """Ids of the patterns in db that match text, from a single linear scan."""
+    matched: Set[int] = set()
+
+    def on_match(pattern_id, start, end, flags, context):
+        matched.add(pattern_id)
+
+    db.scan(text.encode("utf-8"), match_event_handler=on_match)
+    return matched
+
+
+# One DFA scan rules out most texts before any per-pattern regex pass when Hyperscan is installed.
+_NOISE_DB = _compile_hyperscan([re.compile(pattern) for pattern in _NOISE_PATTERNS])
+_FALLBACK_DB = _compile_hyperscan(list(_FALLBACK_FAMILIES))
+
+
+def _is_noise(text: str) -> bool:
+    """Whether a lowercased concept contains bullet artifacts or slide furniture."""
+    if _NOISE_DB is not None and not _hyperscan_matches(_NOISE_DB, text):
+        return False
+    return _NOISE.search(text) is not None
+
 
 class ConceptDetector:
     """Extract key concepts and detect missing ones."""
@@ -18,15 +136,19 @@ class ConceptDetector:
     def __init__(self, embedding_service: EmbeddingService, vector_store: VectorStore):
         self.embedding_service = embedding_service
         self.vector_store = vector_store
+        self.llm_semaphore = llm_semaphore
+        # Slide text never changes after upload, so LLM concepts are memoized per chunk hash
+        self._concept_cache: "OrderedDict[str, frozenset]" = OrderedDict()
+        self._concept_cache_size = 1024
         api_key = os.getenv("OPENAI_API_KEY")
         if api_key:
-            self.client = OpenAI(api_key=api_key)
+            self.client = AsyncOpenAI(api_key=api_key)
             self.use_llm = True
         else:
             self.client = None
             self.use_llm = False
     
-    def extract_concepts(self, slide_data: List[Dict]) -> Set[str]:
+    async def extract_concepts(self, slide_data: List[Dict]) -> Set[str]:
         """
         Extract key concepts from lecture slides using the LLM when available.
         """
@@ -34,34 +156,45 @@ class ConceptDetector:
 
         # Process slides in small chunks to stay under token limits.
         chunk_size = 2
+        chunk_texts = []
         for i in range(0, len(slide_data), chunk_size):
             chunk = slide_data[i : i + chunk_size]
             chunk_text = "\n\n".join(slide["text"] for slide in chunk if slide.get("text"))
-            if not chunk_text.strip():
-                continue
+            if chunk_text.strip():
+                chunk_texts.append(chunk_text)
 
-            if self.use_llm:
-                concepts = self._extract_with_llm(chunk_text)
-            else:
-                concepts = self._extract_from_text_fallback(chunk_text)
+        if self.use_llm:
+            # All chunks are independent, so issue the LLM calls concurrently.
+            results = await asyncio.gather(
+                *[self._extract_with_llm(chunk_text) for chunk_text in chunk_texts]
+            )
+        else:
+            results = [self._extract_from_text_fallback(chunk_text) for chunk_text in chunk_texts]
 
+        for concepts in results:
             all_concepts.update(concepts)
 
         return self._filter_concepts(all_concepts)
     
-    def extract_concepts_from_text(self, text: str) -> Set[str]:
+    async def extract_concepts_from_text(self, text: str) -> Set[str]:
         """Extract concepts from arbitrary text (e.g., student notes)."""
         if not text.strip():
             return set()
 
         if self.use_llm:
-            concepts = self._extract_with_llm(text)
+            concepts = await self._extract_with_llm(text)
         else:
             concepts = self._extract_from_text_fallback(text)
         return self._filter_concepts(concepts)
     
-    def _extract_with_llm(self, text: str) -> Set[str]:
-        """Extract concepts using the LLM."""
+    async def _extract_with_llm(self, text: str) -> Set[str]:
+        """Extract concepts using the LLM, reusing results for text seen before."""
+        cache_key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        cached = self._concept_cache.get(cache_key)
+        if cached is not None:
+            self._concept_cache.move_to_end(cache_key)
+            return set(cached)
+
         try:
             prompt = f"""You are extracting concise study notes from lecture slides.
 
@@ -76,32 +209,36 @@ Rules for every concept:
 Lecture text (ONLY source of truth):
 {text[:2500]}
 
-Return ONLY a valid JSON array of strings, for example:
-["AFST assigns families a risk score from 1–20", "The model uses data from 21 administrative sources including child protective services"]"""
-
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You extract clean, factual lecture concepts. Respond with JSON only.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=350,
-                temperature=0.2,
-            )
-
-            result = response.choices[0].message.content.strip()
-            # Remove optional Markdown wrappers
-            result = re.sub(r"```json\s*", "", result)
-            result = re.sub(r"```\s*", "", result)
-            result = result.strip()
-
-            concepts = json.loads(result)
+Return ONLY a valid JSON object with a "concepts" array of strings, for example:
+{{"concepts": ["AFST assigns families a risk score from 1–20", "The model uses data from 21 administrative sources including child protective services"]}}"""
+
+            async with self.llm_semaphore:
+                response = await self.client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": "You extract clean, factual lecture concepts. Respond with JSON only.",
+                        },
+                        {"role": "user", "content": prompt},
+                    ],
+                    max_tokens=350,
+                    temperature=0.2,
+                    # JSON mode: the reply is a bare JSON object, no Markdown fences to strip
+                    response_format={"type": "json_object"},
+                )
+
+            concepts = orjson.loads(response.choices[0].message.content).get("concepts")
             if isinstance(concepts, list):
-                return set(filter(lambda x: isinstance(x, str), concepts))
-            return set()
+                concepts = set(filter(lambda x: isinstance(x, str), concepts))
+            else:
+                concepts = set()
+
+            # Only successful LLM answers are cached; failures fall back and retry next time
+            self._concept_cache[cache_key] = frozenset(concepts)
+            if len(self._concept_cache) > self._concept_cache_size:
+                self._concept_cache.popitem(last=False)
+            return concepts
 
         except Exception:
             # Fallback to heuristic extraction
@@ -113,47 +250,41 @@ Return ONLY a valid JSON array of strings, for example:
         """
         concepts: Set[str] = set()
 
-        sentences = re.split(r"[.!?]\s+", text)
+        sentences = _SENTENCE_SPLIT.split(text)
         for sentence in sentences:
             sentence = sentence.strip()
             if len(sentence) < 12:
                 continue
 
+            # Prefilter: only run the capturing regexes for families that can match
+            if _FALLBACK_DB is not None:
+                families = _hyperscan_matches(_FALLBACK_DB, sentence)
+                if not families:
+                    continue
+            else:
+                families = range(len(_FALLBACK_FAMILIES))
+
             # Numbered facts
-            number_facts = re.findall(
-                r"(\b[\w\s]{0,40}(?:ranges?|range|from|between|within)\s+\d+(?:\s*[-–]\s*\d+)?(?:\s+\w+)*)",
-                sentence,
-                re.IGNORECASE,
-            )
+            number_facts = _NUMBER_FACT.findall(sentence) if 0 in families else []
             concepts.update(fact.strip() for fact in number_facts)
 
             # Data sources
-            sources = re.findall(
-                r"data\s+from\s+(\d+\s+\w+(?:\s+\w+){0,6})", sentence, re.IGNORECASE
-            )
+            sources = _DATA_SOURCE.findall(sentence) if 1 in families else []
             concepts.update(f"data from {src}".strip() for src in sources)
 
             # Predictions/timeframes
-            predictions = re.findall(
-                r"predicts?\s+([^,\.]+(?:\([^)]+\))?)", sentence, re.IGNORECASE
-            )
+            predictions = _PREDICTION.findall(sentence) if 2 in families else []
             concepts.update(pred.strip() for pred in predictions)
 
             # Definitions
-            definitions = re.findall(
-                r"\b([A-Z][A-Z]+)\s+stands?\s+for\s+([^,\.]+)", sentence
-            )
+            definitions = _DEFINITION.findall(sentence) if 3 in families else []
             concepts.update(
                 f"{abbr} stands for {definition.strip()}"
                 for abbr, definition in definitions
             )
 
             # Capabilities/features
-            capabilities = re.findall(
-                r"\b(?:uses?|includes?|provides?|offers?|relies\s+on)\s+([^,\.]+)",
-                sentence,
-                re.IGNORECASE,
-            )
+            capabilities = _CAPABILITY.findall(sentence) if 4 in families else []
             for cap in capabilities[:3]:
                 cap = cap.strip()
                 if len(cap) > 5 and not cap.lower().startswith(("a ", "an ", "the ")):
@@ -167,38 +298,6 @@ Return ONLY a valid JSON array of strings, for example:
         if not concepts:
             return filtered
 
-        noise_patterns = [
-            r"[•▪◦]",
-            r"--",
-            r"___",
-            r"\bslide\b",
-            r"\bpage\b",
-            r"\bfigure\b",
-            r"\btable\b",
-            r"\buniversity\b",
-            r"\bdepartment\b",
-        ]
-        stop_words = {
-            "the",
-            "and",
-            "or",
-            "but",
-            "in",
-            "on",
-            "at",
-            "to",
-            "for",
-            "of",
-            "with",
-            "by",
-            "a",
-            "an",
-            "is",
-            "are",
-            "was",
-            "were",
-        }
-
         for concept in concepts:
             if not concept:
                 continue
@@ -208,29 +307,27 @@ Return ONLY a valid JSON array of strings, for example:
                 continue
 
             # Remove leading bullets/numbering
-            concept_clean = re.sub(r"^[\d\.\)\-]+\s*", "", concept_clean)
+            concept_clean = _LEADING_NUMBERING.sub("", concept_clean)
 
             # Very short concepts are rarely useful (unless contain numbers/proper nouns)
             if len(concept_clean) < 6:
-                if not re.search(r"\d", concept_clean) and not re.search(
-                    r"\b[A-Z][a-z]+\b", concept_clean
-                ):
+                if not _DIGIT.search(concept_clean) and not _CAPITALIZED_WORD.search(concept_clean):
                     continue
 
             # Remove repeated punctuation / bullet artifacts
-            if any(re.search(pattern, concept_clean.lower()) for pattern in noise_patterns):
+            if _is_noise(concept_clean.lower()):
                 continue
 
             # Skip if mostly stopwords (e.g., "the system is")
             words = concept_clean.lower().split()
             if not words:
                 continue
-            stopword_ratio = sum(1 for w in words if w in stop_words) / len(words)
+            stopword_ratio = sum(1 for w in words if w in _STOP_WORDS) / len(words)
             if stopword_ratio > 0.65 and len(words) < 5:
                 continue
 
             # Skip if no meaningful nouns or verbs
-            if not re.search(r"[A-Za-z]{3,}", concept_clean):
+            if not _MEANINGFUL_WORD.search(concept_clean):
                 continue
 
             filtered.add(concept_clean)
@@ -267,24 +364,25 @@ Return ONLY a valid JSON array of strings, for example:
         
         # Embed missing concepts and notes concepts
         missing_embeddings = self.embedding_service.embed_batch(missing_list)
-        notes_embeddings = self.embedding_service.embed_batch(notes_list)
+        notes_embeddings = self.embedding_service.embed_batch(notes_list, persist=False)
         
         # Find truly missing concepts (low similarity to any note concept)
-        truly_missing = []
         similarity_threshold = 0.75  # High threshold to ensure concepts are actually missing
+        _, max_similarities = self.embedding_service.best_matches(
+            missing_embeddings, notes_embeddings
+        )
         
-        for i, missing_concept in enumerate(missing_list):
-            missing_emb = missing_embeddings[i]
-            max_similarity = 0.0
-            
-            for note_emb in notes_embeddings:
-                similarity = self.embedding_service.similarity(missing_emb, note_emb)
-                max_similarity = max(max_similarity, similarity)
-            
-            if max_similarity < similarity_threshold:
-                truly_missing.append(missing_concept)
+        truly_missing = np.flatnonzero(max_similarities < similarity_threshold)
+        
+        # Limit to the 10 least-covered concepts, selected without a full sort
+        limit = 10
+        if truly_missing.size > limit:
+            truly_missing = truly_missing[
+                np.argpartition(max_similarities[truly_missing], limit - 1)[:limit]
+            ]
+        truly_missing = truly_missing[np.argsort(max_similarities[truly_missing], kind="stable")]
         
-        return truly_missing[:10]  # Limit to top 10 missing concepts
+        return [missing_list[i] for i in truly_missing]
 
     def select_priority_concepts(self, concepts: Set[str], limit: int = 5) -> List[str]:
         """Select the most informative concepts to use as hints."""
@@ -293,7 +391,7 @@ Return ONLY a valid JSON array of strings, for example:
 
         def score(concept: str) -> int:
             s = 0
-            if re.search(r"\d", concept):
+            if _DIGIT.search(concept):
                 s += 3
             if len(concept.split()) >= 4:
                 s += 2
@@ -301,6 +399,5 @@ Return ONLY a valid JSON array of strings, for example:
                 s += 1
             return s
 
-        ranked = sorted(concepts, key=lambda c: (score(c), len(c)), reverse=True)
-        return ranked[:limit]
+        return heapq.nlargest(limit, concepts, key=lambda c: (score(c), len(c)))
 
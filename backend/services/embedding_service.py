@@ -3,26 +3,132 @@ Embedding service for generating sentence/document embeddings
 """
 from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import List, Union
+import asyncio
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    from numba import njit, prange
+except ImportError:  # Optional: best_matches falls back to a NumPy matmul + argmax
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _best_matches_kernel(queries, matrix, out_indices, out_similarities):
+        """Fused dot product -> max -> argmax, one pass over matrix per query row"""
+        for i in prange(queries.shape[0]):
+            best_index = 0
+            best_similarity = -2.0  # below any cosine similarity
+            for j in range(matrix.shape[0]):
+                similarity = 0.0
+                for k in range(matrix.shape[1]):
+                    similarity += queries[i, k] * matrix[j, k]
+                if similarity > best_similarity:
+                    best_similarity = similarity
+                    best_index = j
+            out_indices[i] = best_index
+            out_similarities[i] = best_similarity
 
 
 class EmbeddingService:
     """Generate embeddings using sentence transformers"""
     
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache_path: Optional[Union[str, Path]] = "cache/embeddings.db",
+        memory_cache_size: int = 2048,
+        max_batch_size: int = 64,
+        max_batch_wait: float = 0.01,
+        onnx_path: Optional[Union[str, Path]] = None,
+        disk_cache_max_entries: int = 100_000,
+        disk_write_batch: int = 64
+    ):
         """
         Initialize embedding model
         Using MiniLM for fast, lightweight embeddings
+        
+        Embeddings are cached by content hash: an in-process LRU in front of a
+        SQLite table at cache_path (pass None to disable the on-disk cache).
+        Disk writes are buffered and flushed every disk_write_batch new rows;
+        the table keeps at most disk_cache_max_entries rows, oldest dropped first.
+        Texts embedded with persist=False (one-off notes) stay in memory only
+        
+        aembed() coalesces concurrent requests into one model batch of up to
+        max_batch_size texts, waiting at most max_batch_wait seconds to fill it
+        
+        If onnx_path (or EMBEDDING_ONNX_PATH) points at an exported, int8-quantized
+        ONNX model, it is served with ONNX Runtime instead of PyTorch; the
+        tokenizer is loaded from the same directory (see README)
         """
-        self.model = SentenceTransformer(model_name)
-        self.embedding_dim = 384  # MiniLM dimension
+        self.model_name = model_name
+        self.model = None
+        self.session = None
+        onnx_path = onnx_path or os.getenv("EMBEDDING_ONNX_PATH")
+        if onnx_path:
+            import onnxruntime
+            from transformers import AutoTokenizer
+            
+            onnx_path = Path(onnx_path)
+            self.session = onnxruntime.InferenceSession(
+                str(onnx_path), providers=["CPUExecutionProvider"]
+            )
+            self.tokenizer = AutoTokenizer.from_pretrained(str(onnx_path.parent))
+            self._onnx_inputs = {inp.name for inp in self.session.get_inputs()}
+            hidden_dim = self.session.get_outputs()[0].shape[-1]
+            self.embedding_dim = hidden_dim if isinstance(hidden_dim, int) else 384
+            # Quantized vectors differ slightly, so keep them apart in the cache
+            self._cache_namespace = f"{model_name}:{onnx_path.name}"
+        else:
+            import torch
+            
+            # Leave cores for concurrent requests instead of one pool thrashing them all
+            torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+            self.model = SentenceTransformer(model_name)
+            self.embedding_dim = self.model.get_sentence_embedding_dimension() or 384  # MiniLM: 384
+            self._cache_namespace = model_name
+        
+        self._memory_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._memory_cache_size = memory_cache_size
+        self._cache_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_cache_max_entries = disk_cache_max_entries
+        self._disk_write_batch = disk_write_batch
+        self._pending_rows: List[Tuple[bytes, str, bytes]] = []
+        if cache_path:
+            cache_path = Path(cache_path)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(cache_path), check_same_thread=False)
+            # WAL with synchronous=NORMAL: commits don't fsync; a crash only loses recent cache rows
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, model TEXT NOT NULL, vec BLOB NOT NULL)"
+            )
+            self._db.commit()
+            atexit.register(self.flush)
+        
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._batch_task: Optional[asyncio.Task] = None
     
-    def embed(self, text: Union[str, List[str]]) -> np.ndarray:
+    def embed(self, text: Union[str, List[str]], persist: bool = True) -> np.ndarray:
         """
         Generate embedding(s) for text
         
         Args:
             text: Single string or list of strings
+            persist: Also store new embeddings in the on-disk cache
             
         Returns:
             numpy array of embeddings (shape: (n, 384) for list, (384,) for single)
@@ -30,7 +136,7 @@ class EmbeddingService:
         if isinstance(text, str):
             text = [text]
         
-        embeddings = self.model.encode(text, convert_to_numpy=True)
+        embeddings = self.embed_batch(text, persist=persist)
         
         # If single text, return 1D array
         if len(embeddings.shape) == 2 and embeddings.shape[0] == 1:
@@ -38,18 +144,249 @@ class EmbeddingService:
         
         return embeddings
     
-    def embed_batch(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
-        """Generate embeddings for a batch of texts"""
-        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+    def embed_batch(self, texts: List[str], batch_size: int = 32, persist: bool = True) -> np.ndarray:
+        """
+        Generate unit-length embeddings for a batch of texts, encoding only cache misses
+        
+        Pass persist=False for text unlikely to recur (student notes) to keep it
+        out of the on-disk cache
+        """
+        embeddings = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        keys = [self._cache_key(text) for text in texts]
+        
+        cached = self._cache_get(keys)
+        missing: Dict[bytes, List[int]] = {}
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+            else:
+                missing.setdefault(key, []).append(i)
+        
+        if missing:
+            missing_keys = list(missing)
+            encoded = self._encode(
+                [texts[missing[key][0]] for key in missing_keys], batch_size
+            )
+            for key, embedding in zip(missing_keys, encoded):
+                embeddings[missing[key]] = embedding
+            self._cache_put(dict(zip(missing_keys, encoded)), persist)
+        
+        return embeddings
+    
+    def warmup(self) -> None:
+        """
+        Run the batched and single-item encode paths (and the Numba kernel) once
+        
+        Bypasses the embedding cache so the model really executes; called at
+        startup so the first request does not pay graph/kernel initialization
+        """
+        embeddings = self._encode(["warmup"] * 8, 8)
+        self._encode([""], 1)
+        self.best_matches(embeddings[:2], embeddings)
+    
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """Run the model (PyTorch or ONNX Runtime) on texts that missed the cache"""
+        if self.session is None:
+            return self.model.encode(
+                texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True
+            ).astype(np.float32, copy=False)
+        
+        embeddings = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        # Length-sorted batches keep padding to a minimum
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            tokens = self.tokenizer(
+                [texts[i] for i in indices],
+                padding=True,
+                truncation=True,
+                max_length=256,
+                return_tensors="np"
+            )
+            feeds = {
+                name: tokens[name].astype(np.int64)
+                for name in ("input_ids", "attention_mask", "token_type_ids")
+                if name in self._onnx_inputs and name in tokens
+            }
+            hidden = self.session.run(None, feeds)[0]
+            
+            # Mean pooling over real tokens, then L2-normalize like the sentence-transformers model
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings[indices] = self.normalize(pooled)
+        return embeddings
+    
+    async def aembed(self, text: str, persist: bool = True) -> np.ndarray:
+        """
+        Embed a single text from async code
+        
+        Concurrent callers (e.g. simultaneous FastAPI requests) share one
+        model.encode call instead of each running its own small forward pass
+        """
+        loop = asyncio.get_running_loop()
+        if self._batch_queue is None or self._batch_loop is not loop:
+            self._batch_queue = asyncio.Queue()
+            self._batch_loop = loop
+            self._batch_task = loop.create_task(self._run_batcher(self._batch_queue))
+        
+        future = loop.create_future()
+        await self._batch_queue.put((text, persist, future))
+        return await future
+    
+    async def _run_batcher(self, queue: asyncio.Queue) -> None:
+        """Drain queued texts into batches and resolve each caller's future"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_batch_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            for persist in (True, False):
+                group = [(text, future) for text, text_persist, future in batch if text_persist is persist]
+                if not group:
+                    continue
+                try:
+                    # Encode off the event loop so new requests keep queueing meanwhile
+                    embeddings = await asyncio.to_thread(
+                        self.embed_batch, [text for text, _ in group], self.max_batch_size, persist
+                    )
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                
+                for (_, future), embedding in zip(group, embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
     
     def similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
-        """Compute cosine similarity between two embeddings"""
-        # Normalize embeddings
-        norm1 = np.linalg.norm(embedding1)
-        norm2 = np.linalg.norm(embedding2)
+        """
+        Compute cosine similarity between two arbitrary embeddings
         
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
+        Kept for vectors that did not come from this service; embeddings from
+        embed()/embed_batch() are already unit length, use similarity_normalized
+        """
+        return self.similarity_normalized(self.normalize(embedding1), self.normalize(embedding2))
+    
+    @staticmethod
+    def similarity_normalized(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
+        """Cosine similarity of two unit-length embeddings (a plain dot product)"""
+        return float(embedding1 @ embedding2)
+    
+    @staticmethod
+    def similarity_matrix(embeddings1: np.ndarray, embeddings2: np.ndarray) -> np.ndarray:
+        """Cosine similarity between every row of two unit-length embedding matrices"""
+        return embeddings1 @ embeddings2.T
+    
+    @staticmethod
+    def best_matches(queries: np.ndarray, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        For each unit-length query row, the index and similarity of its most
+        similar row in matrix (both non-empty)
         
-        return np.dot(embedding1, embedding2) / (norm1 * norm2)
-
+        Uses a parallel Numba kernel when numba is installed, so the full
+        (queries x matrix) similarity matrix is never materialized
+        """
+        if njit is None:
+            similarities = queries @ matrix.T
+            indices = similarities.argmax(axis=1)
+            return indices, similarities[np.arange(len(indices)), indices]
+        
+        indices = np.empty(queries.shape[0], dtype=np.int64)
+        similarities = np.empty(queries.shape[0], dtype=np.float32)
+        _best_matches_kernel(
+            np.ascontiguousarray(queries, dtype=np.float32),
+            np.ascontiguousarray(matrix, dtype=np.float32),
+            indices,
+            similarities
+        )
+        return indices, similarities
+    
+    @staticmethod
+    def normalize(embeddings: np.ndarray) -> np.ndarray:
+        """L2-normalize embeddings along the last axis (zero vectors stay zero)"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+    
+    def _cache_key(self, text: str) -> bytes:
+        """Content hash of text, namespaced by model so a model switch never collides"""
+        return hashlib.blake2b(f"{self._cache_namespace}|{text}".encode("utf-8"), digest_size=32).digest()
+    
+    def _cache_get(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Look keys up in the memory LRU, then in SQLite (promoting hits to memory)"""
+        found: Dict[bytes, np.ndarray] = {}
+        with self._cache_lock:
+            for key in keys:
+                embedding = self._memory_cache.get(key)
+                if embedding is not None:
+                    self._memory_cache.move_to_end(key)
+                    found[key] = embedding
+            
+            pending = list({key for key in keys if key not in found})
+            if self._db is None or not pending:
+                return found
+            
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(pending), 500):
+                chunk = pending[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, vec in rows:
+                    embedding = np.frombuffer(vec, dtype=np.float32)
+                    found[key] = embedding
+                    self._remember(key, embedding)
+        return found
+    
+    def _cache_put(self, entries: Dict[bytes, np.ndarray], persist: bool = True) -> None:
+        """Store freshly computed embeddings in memory, and buffer them for SQLite if persist"""
+        with self._cache_lock:
+            for key, embedding in entries.items():
+                self._remember(key, embedding)
+            if self._db is None or not persist:
+                return
+            self._pending_rows.extend(
+                (key, self._cache_namespace, embedding.tobytes()) for key, embedding in entries.items()
+            )
+            if len(self._pending_rows) >= self._disk_write_batch:
+                self._flush_locked()
+    
+    def flush(self) -> None:
+        """Write buffered embeddings to SQLite (also runs at interpreter exit)"""
+        with self._cache_lock:
+            self._flush_locked()
+    
+    def _flush_locked(self) -> None:
+        """Insert pending rows and trim the table to its cap; caller holds _cache_lock"""
+        if self._db is None or not self._pending_rows:
+            return
+        self._db.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, model, vec) VALUES (?, ?, ?)", self._pending_rows
+        )
+        self._pending_rows.clear()
+        # rowid follows insertion order, so the oldest rows are dropped first
+        excess = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self._disk_cache_max_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)", (excess,)
+            )
+        self._db.commit()
+    
+    def _remember(self, key: bytes, embedding: np.ndarray) -> None:
+        """Insert into the memory LRU, evicting the least recently used entry"""
+        self._memory_cache[key] = embedding
+        self._memory_cache.move_to_end(key)
+        while len(self._memory_cache) > self._memory_cache_size:
+            self._memory_cache.popitem(last=False)
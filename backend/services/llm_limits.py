@@ -0,0 +1,10 @@
+"""
+Concurrency limits shared by the services that call the OpenAI API
+"""
+import asyncio
+
+# Cap concurrent LLM calls per process to stay within OpenAI rate limits
+LLM_CONCURRENCY = 8
+
+# One semaphore for every detector, so the cap holds for the process as a whole
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
@@ -1,14 +1,39 @@
 """
 Misconception detection service
 """
+import asyncio
+import hashlib
 import re
-from typing import List, Dict, Tuple
+from collections import OrderedDict
+from typing import List, Dict, FrozenSet, Optional, Tuple
 import numpy as np
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI
 from .embedding_service import EmbeddingService
+from .llm_limits import llm_semaphore
 from storage.vector_store import VectorStore
 
+# Compiled once at import; both run for every sentence / sentence pair
+_SENTENCE_SPLIT = re.compile(r'[.!?]\s+')
+_NUMBER = re.compile(r'\d+\.?\d*')
+_WORD = re.compile(r'\w+')
+
+# (negative, positive) word pairs that signal a contradiction when split across
+# the note and the lecture. Each pair owns one bit, so a sentence's words reduce
+# to two masks and a pair check is a single AND.
+_CONTRADICTION_PAIRS = [
+    ('not', 'is'), ('no', 'yes'), ('never', 'always'),
+    ('cannot', 'can'), ('wrong', 'correct'), ('incorrect', 'correct')
+]
+_NEGATIVE_BITS: Dict[str, int] = {}
+_POSITIVE_BITS: Dict[str, int] = {}
+for _bit, (_neg_word, _pos_word) in enumerate(_CONTRADICTION_PAIRS):
+    _NEGATIVE_BITS[_neg_word] = _NEGATIVE_BITS.get(_neg_word, 0) | (1 << _bit)
+    _POSITIVE_BITS[_pos_word] = _POSITIVE_BITS.get(_pos_word, 0) | (1 << _bit)
+
+# (negative pair bits, positive pair bits, numbers) extracted once per sentence
+SentenceFeatures = Tuple[int, int, FrozenSet[str]]
+
 
 class MisconceptionDetector:
     """Detect misconceptions and conflicting statements"""
@@ -17,15 +42,20 @@ class MisconceptionDetector:
         self.embedding_service = embedding_service
         self.vector_store = vector_store
         self.contradiction_threshold = 0.3  # Threshold for contradiction detection
+        self.llm_semaphore = llm_semaphore
+        # Covered slides repeat across scan-notes / refresh-question calls, so
+        # lecture sentences and their embeddings are cached by lecture text hash
+        self._lecture_cache: "OrderedDict[bytes, Tuple[List[str], np.ndarray]]" = OrderedDict()
+        self._lecture_cache_size = 64
         api_key = os.getenv("OPENAI_API_KEY")
         if api_key:
-            self.client = OpenAI(api_key=api_key)
+            self.client = AsyncOpenAI(api_key=api_key)
             self.use_llm = True
         else:
             self.client = None
             self.use_llm = False
     
-    def detect(self, notes_text: str, slide_data: List[Dict]) -> List[Dict]:
+    async def detect(self, notes_text: str, slide_data: List[Dict]) -> List[Dict]:
         """
         Detect misconceptions in notes by comparing against lecture content
         
@@ -40,114 +70,167 @@ class MisconceptionDetector:
         
         # Split notes into sentences
         note_sentences = self._split_into_sentences(notes_text)
+        if not note_sentences:
+            return misconceptions
         
-        # Get lecture text
+        # Get lecture text, split and embedded once per distinct set of covered slides
         lecture_text = ' '.join([slide['text'] for slide in slide_data])
-        lecture_sentences = self._split_into_sentences(lecture_text)
+        lecture_sentences, lecture_embeddings = await self._get_lecture_sentences(lecture_text)
+        if not lecture_sentences:
+            return misconceptions
         
-        # Embed all sentences
-        note_embeddings = self.embedding_service.embed_batch(note_sentences)
-        lecture_embeddings = self.embedding_service.embed_batch(lecture_sentences)
+        # Embed all note sentences
+        note_embeddings = await asyncio.to_thread(
+            self.embedding_service.embed_batch, note_sentences, persist=False
+        )
         
-        # Check each note sentence for contradictions
-        for i, note_sentence in enumerate(note_sentences):
-            note_emb = note_embeddings[i]
-            
-            # Find most similar lecture sentence
-            max_similarity = 0.0
-            best_lecture_idx = -1
-            
-            for j, lecture_emb in enumerate(lecture_embeddings):
-                similarity = self.embedding_service.similarity(note_emb, lecture_emb)
-                if similarity > max_similarity:
-                    max_similarity = similarity
-                    best_lecture_idx = j
+        # Find the most similar lecture sentence for every note sentence at once
+        best_lecture_indices, max_similarities = self.embedding_service.best_matches(
+            note_embeddings, lecture_embeddings
+        )
+        
+        # Only note sentences similar enough to a lecture sentence are checked for contradictions
+        candidates = [int(i) for i in np.flatnonzero(max_similarities > 0.5)]
+        
+        # Use LLM for better misconception detection, checking all candidates concurrently
+        if self.use_llm:
+            lecture_context = lecture_text[:1000]
+            results = await asyncio.gather(*[
+                self._check_with_llm(
+                    note_sentences[i],
+                    lecture_sentences[best_lecture_indices[i]],
+                    lecture_context,
+                    float(max_similarities[i])
+                )
+                for i in candidates
+            ])
+            for i, (is_misconception, correction) in zip(candidates, results):
+                if is_misconception:
+                    misconceptions.append({
+                        'text': note_sentences[i],
+                        'suggestion': correction,
+                        'position': i
+                    })
+            return misconceptions
+        
+        # Fallback to heuristic method; each lecture sentence is tokenized at most once
+        lecture_features: Dict[int, SentenceFeatures] = {}
+        for i in candidates:
+            best_lecture_idx = int(best_lecture_indices[i])
+            if best_lecture_idx not in lecture_features:
+                lecture_features[best_lecture_idx] = self._sentence_features(
+                    lecture_sentences[best_lecture_idx]
+                )
+            contradiction_score = self._check_contradiction(
+                note_sentences[i],
+                lecture_sentences[best_lecture_idx],
+                float(max_similarities[i]),
+                self._sentence_features(note_sentences[i]),
+                lecture_features[best_lecture_idx]
+            )
             
-            # If similar enough, check for contradictions
-            if max_similarity > 0.5 and best_lecture_idx >= 0:
-                # Use LLM for better misconception detection
-                if self.use_llm:
-                    is_misconception, correction = self._check_with_llm(
-                        note_sentence,
-                        lecture_sentences[best_lecture_idx],
-                        lecture_text
-                    )
-                    if is_misconception:
-                        misconceptions.append({
-                            'text': note_sentence,
-                            'suggestion': correction,
-                            'position': i
-                        })
-                else:
-                    # Fallback to heuristic method
-                    contradiction_score = self._check_contradiction(
-                        note_sentence,
-                        lecture_sentences[best_lecture_idx]
-                    )
-                    
-                    if contradiction_score > self.contradiction_threshold:
-                        correction = self._extract_correction(
-                            lecture_sentences[best_lecture_idx]
-                        )
-                        
-                        misconceptions.append({
-                            'text': note_sentence,
-                            'suggestion': correction,
-                            'position': i
-                        })
+            if contradiction_score > self.contradiction_threshold:
+                correction = self._extract_correction(
+                    lecture_sentences[best_lecture_idx]
+                )
+                
+                misconceptions.append({
+                    'text': note_sentences[i],
+                    'suggestion': correction,
+                    'position': i
+                })
         
         return misconceptions
     
+    async def _get_lecture_sentences(self, lecture_text: str) -> Tuple[List[str], np.ndarray]:
+        """Split and embed lecture text, reusing the result for identical text"""
+        key = hashlib.blake2b(lecture_text.encode('utf-8'), digest_size=16).digest()
+        cached = self._lecture_cache.get(key)
+        if cached is not None:
+            self._lecture_cache.move_to_end(key)
+            return cached
+        
+        lecture_sentences = self._split_into_sentences(lecture_text)
+        # Encoding is CPU-bound; the cache is still only read and written on the event loop
+        lecture_embeddings = await asyncio.to_thread(self.embedding_service.embed_batch, lecture_sentences)
+        self._lecture_cache[key] = (lecture_sentences, lecture_embeddings)
+        if len(self._lecture_cache) > self._lecture_cache_size:
+            self._lecture_cache.popitem(last=False)
+        return lecture_sentences, lecture_embeddings
+    
     def _split_into_sentences(self, text: str) -> List[str]:
         """Split text into sentences"""
         # Simple sentence splitting
-        sentences = re.split(r'[.!?]\s+', text)
-        return [s.strip() for s in sentences if len(s.strip()) > 10]
+        sentences = (s.strip() for s in _SENTENCE_SPLIT.split(text))
+        return [s for s in sentences if len(s) > 10]
     
-    def _check_contradiction(self, note_sentence: str, lecture_sentence: str) -> float:
+    def _sentence_features(self, sentence: str) -> SentenceFeatures:
+        """
+        Tokenize a sentence once for the contradiction heuristic
+        
+        Returns:
+            (negative-word pair bits, positive-word pair bits, numbers in the sentence)
+        """
+        negative_mask = 0
+        positive_mask = 0
+        for word in set(_WORD.findall(sentence.lower())):
+            negative_mask |= _NEGATIVE_BITS.get(word, 0)
+            positive_mask |= _POSITIVE_BITS.get(word, 0)
+        return negative_mask, positive_mask, frozenset(_NUMBER.findall(sentence))
+    
+    def _check_contradiction(
+        self,
+        note_sentence: str,
+        lecture_sentence: str,
+        similarity: float,
+        note_features: Optional[SentenceFeatures] = None,
+        lecture_features: Optional[SentenceFeatures] = None
+    ) -> float:
         """
         Check if note sentence contradicts lecture sentence
         
+        similarity is the cosine similarity of the pair, already computed in
+        detect(); features (from _sentence_features) are computed here unless passed in
+        
         Returns:
             Contradiction score (0-1, higher = more contradictory)
         """
         # Simple heuristic: check for negation patterns
-        note_lower = note_sentence.lower()
-        lecture_lower = lecture_sentence.lower()
-        
-        # Check for explicit contradictions
-        contradiction_words = [
-            ('not', 'is'), ('no', 'yes'), ('never', 'always'),
-            ('cannot', 'can'), ('wrong', 'correct'), ('incorrect', 'correct')
-        ]
-        
-        contradiction_score = 0.0
-        
-        for neg_word, pos_word in contradiction_words:
-            if neg_word in note_lower and pos_word in lecture_lower:
-                contradiction_score += 0.3
-            elif pos_word in note_lower and neg_word in lecture_lower:
-                contradiction_score += 0.3
-        
-        # Check for conflicting numbers/values
-        note_numbers = re.findall(r'\d+\.?\d*', note_sentence)
-        lecture_numbers = re.findall(r'\d+\.?\d*', lecture_sentence)
-        
-        if note_numbers and lecture_numbers:
-            # If same concept but different numbers, likely contradiction
-            if len(set(note_numbers) & set(lecture_numbers)) == 0:
-                # Check semantic similarity to see if same concept
-                note_emb = self.embedding_service.embed(note_sentence)
-                lecture_emb = self.embedding_service.embed(lecture_sentence)
-                similarity = self.embedding_service.similarity(note_emb, lecture_emb)
-                
-                if similarity > 0.6:  # Same concept but different numbers
-                    contradiction_score += 0.4
+        note_negative, note_positive, note_numbers = (
+            note_features or self._sentence_features(note_sentence)
+        )
+        lecture_negative, lecture_positive, lecture_numbers = (
+            lecture_features or self._sentence_features(lecture_sentence)
+        )
+        
+        # Check for explicit contradictions: 0.3 per pair split across the two sentences
+        clashing_pairs = (note_negative & lecture_positive) | (note_positive & lecture_negative)
+        contradiction_score = 0.3 * clashing_pairs.bit_count()
+        
+        # Check for conflicting numbers/values: same concept but different numbers
+        if (
+            note_numbers
+            and lecture_numbers
+            and note_numbers.isdisjoint(lecture_numbers)
+            and similarity > 0.6
+        ):
+            contradiction_score += 0.4
         
         return min(contradiction_score, 1.0)
     
-    def _check_with_llm(self, note_sentence: str, lecture_sentence: str, full_lecture: str) -> Tuple[bool, str]:
-        """Use LLM to check if note sentence is a misconception"""
+    async def _check_with_llm(
+        self,
+        note_sentence: str,
+        lecture_sentence: str,
+        lecture_context: str,
+        similarity: float
+    ) -> Tuple[bool, str]:
+        """
+        Use LLM to check if note sentence is a misconception
+        
+        lecture_context is the (already truncated) lecture excerpt shared by every
+        check; similarity is only needed for the heuristic fallback
+        """
         try:
             prompt = f"""Compare these two statements:
 
@@ -155,7 +238,7 @@ Student's note: "{note_sentence}"
 Lecture content: "{lecture_sentence}"
 
 Full lecture context:
-{full_lecture[:1000]}
+{lecture_context}
 
 Is the student's note INCORRECT or a MISCONCEPTION compared to the lecture? 
 - If the note is CORRECT or just paraphrased differently, respond with: NO
@@ -165,15 +248,16 @@ If YES, provide a concise correction (1-2 sentences) explaining what's actually
 Format: YES|correction text
 If NO, respond with: NO"""
 
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an expert at detecting misconceptions in student notes by comparing them to lecture content. Only flag actual incorrect information, not paraphrasing."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=200,
-                temperature=0.3
-            )
+            async with self.llm_semaphore:
+                response = await self.client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {"role": "system", "content": "You are an expert at detecting misconceptions in student notes by comparing them to lecture content. Only flag actual incorrect information, not paraphrasing."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=200,
+                    temperature=0.3
+                )
             
             result = response.choices[0].message.content.strip()
             
@@ -186,7 +270,9 @@ If NO, respond with: NO"""
         
         except Exception as e:
             # Fallback to heuristic
-            contradiction_score = self._check_contradiction(note_sentence, lecture_sentence)
+            contradiction_score = self._check_contradiction(
+                note_sentence, lecture_sentence, similarity
+            )
             if contradiction_score > self.contradiction_threshold:
                 return True, self._extract_correction(lecture_sentence)
             return False, ""
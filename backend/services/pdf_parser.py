@@ -1,20 +1,172 @@
 """
 PDF parsing service for extracting text from lecture slides
 """
+import asyncio
+import atexit
+import hashlib
+import os
+import tempfile
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
-import PyPDF2
+from typing import List, Optional, Tuple, Union
+import fitz  # PyMuPDF
 from pdf2image import convert_from_path
 import pytesseract
 from PIL import Image
 import io
+import orjson
+
+try:
+    import tesserocr
+except ImportError:  # Optional: OCR falls back to one pytesseract subprocess per page
+    tesserocr = None
+
+# Tesseract cost scales with pixel count: clean slide text reads fine at 150 DPI,
+# while pages with no text layer at all are likely scans and get 300 DPI
+_OCR_DPI = 150
+_SCAN_DPI = 300
+
+# Skip OCR entirely when more than this share of pages already has a text layer
+_OCR_SKIP_RATIO = 0.8
+
+# pdftoppm rasterizes pages across this many threads
+_RENDER_THREADS = os.cpu_count() or 1
+
+
+# OCR gets its own thread pool: it bounds concurrent tesseract runs and, with
+# tesserocr, the number of loaded engines (one per OCR thread)
+_OCR_WORKERS = os.cpu_count() or 1
+_ocr_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _get_ocr_pool() -> ThreadPoolExecutor:
+    """Create the shared OCR pool on first use"""
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=_OCR_WORKERS, thread_name_prefix="ocr")
+    return _ocr_pool
+
+
+_tess_local = threading.local()
+_tess_apis: List["tesserocr.PyTessBaseAPI"] = []
+_tess_apis_lock = threading.Lock()
+
+
+def _end_tess_apis() -> None:
+    """Release every loaded Tesseract engine at interpreter exit"""
+    with _tess_apis_lock:
+        for api in _tess_apis:
+            api.End()
+        _tess_apis.clear()
+
+
+def _tesserocr_image_to_string(image: Union[Image.Image, str]) -> str:
+    """OCR through the Tesseract C API, keeping one loaded engine per OCR pool thread"""
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        # PyTessBaseAPI is not thread-safe, so each OCR thread owns its own instance
+        api = _tess_local.api = tesserocr.PyTessBaseAPI(lang="eng")
+        with _tess_apis_lock:
+            if not _tess_apis:
+                atexit.register(_end_tess_apis)
+            _tess_apis.append(api)
+    if isinstance(image, str):
+        api.SetImageFile(image)
+    else:
+        api.SetImage(image)
+    return api.GetUTF8Text()
+
+
+class _SingleThreadedEnv(Mapping):
+    """Live view of os.environ with OMP_THREAD_LIMIT=1, used as the tesseract child environment"""
+    
+    def __getitem__(self, key: str) -> str:
+        if key == "OMP_THREAD_LIMIT":
+            return "1"
+        return os.environ[key]
+    
+    def __iter__(self):
+        yield "OMP_THREAD_LIMIT"
+        yield from (key for key in os.environ if key != "OMP_THREAD_LIMIT")
+    
+    def __len__(self) -> int:
+        return len(os.environ) + ("OMP_THREAD_LIMIT" not in os.environ)
+
+
+def _use_single_threaded_tesseract() -> None:
+    """
+    Run every tesseract process pytesseract spawns with OMP_THREAD_LIMIT=1
+    
+    Pages are OCR'd in parallel, so each tesseract process should stay single-threaded.
+    The limit is set for the child only: exporting it in os.environ would also cap the
+    OpenMP pools torch and numba use in this process.
+    """
+    # pytesseract passes its module-level environ as env= to each tesseract it spawns
+    if not hasattr(pytesseract.pytesseract, "environ"):
+        print("[PDFParser] Cannot scope OMP_THREAD_LIMIT for this pytesseract version; tesseract may oversubscribe cores")
+        return
+    pytesseract.pytesseract.environ = _SingleThreadedEnv()
+
+
+_image_to_string = _tesserocr_image_to_string if tesserocr is not None else pytesseract.image_to_string
+
+
+def _extract_text(pdf_path: Path) -> List[str]:
+    """Extract the embedded text layer of every page (blocking)"""
+    with fitz.open(str(pdf_path)) as doc:
+        return [doc.load_page(page_num).get_text("text") for page_num in range(doc.page_count)]
+
+
+# Part of every parse cache key, so changing how pages are parsed never serves stale output
+_PARSE_CACHE_TAG = hashlib.blake2b(
+    repr((1, _OCR_DPI, _SCAN_DPI, _OCR_SKIP_RATIO, "tesserocr" if tesserocr else "pytesseract")).encode("utf-8"),
+    digest_size=4
+).hexdigest()
+
+
+def _file_digest(file_path: Path) -> str:
+    """Content hash of a file, read in 1 MiB blocks"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _render_pages(pdf_path: Path, page_nums: List[int], dpis: List[int]) -> List[Image.Image]:
+    """Rasterize PDF pages in-process with MuPDF as grayscale images (blocking)"""
+    images = []
+    with fitz.open(str(pdf_path)) as doc:
+        for page_num, dpi in zip(page_nums, dpis):
+            pix = doc.load_page(page_num).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            # Wrap the raw samples directly instead of round-tripping through PNG
+            images.append(Image.frombytes("L", (pix.width, pix.height), pix.samples))
+    return images
 
 
 class PDFParser:
     """Parse PDF files and extract text per slide/page"""
     
-    def __init__(self):
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = "cache/pdf",
+        cache_max_bytes: int = 500 * 1024 * 1024
+    ):
+        """
+        Parsed PDFs are cached as JSON under cache_dir, keyed by file content, so
+        re-uploading a deck skips extraction and OCR; least recently used entries
+        are evicted beyond cache_max_bytes (pass cache_dir=None to disable)
+        """
         self.supported_formats = ['.pdf', '.png', '.jpg', '.jpeg']
+        self.cache_dir: Optional[Path] = None
+        self.cache_max_bytes = cache_max_bytes
+        if cache_dir:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if tesserocr is None:
+            _use_single_threaded_tesseract()
     
     async def parse(self, file_path: Path) -> List[str]:
         """
@@ -23,44 +175,88 @@ class PDFParser:
         file_path = Path(file_path)
         
         if file_path.suffix.lower() == '.pdf':
-            return await self._parse_pdf(file_path)
+            if self.cache_dir is None:
+                slides, _ = await self._parse_pdf(file_path)
+                return slides
+            
+            digest = await asyncio.to_thread(_file_digest, file_path)
+            cache_file = self.cache_dir / f"{digest}-{_PARSE_CACHE_TAG}.json"
+            slides = await asyncio.to_thread(self._cache_get, cache_file)
+            if slides is None:
+                slides, complete = await self._parse_pdf(file_path)
+                # Output degraded by unavailable OCR must be retried once OCR works again
+                if complete:
+                    await asyncio.to_thread(self._cache_put, cache_file, slides)
+            return slides
         elif file_path.suffix.lower() in ['.png', '.jpg', '.jpeg']:
             return await self._parse_image(file_path)
         else:
             raise ValueError(f"Unsupported file format: {file_path.suffix}")
     
-    async def _parse_pdf(self, pdf_path: Path) -> List[str]:
-        """Extract text from PDF pages"""
+    def _cache_get(self, cache_file: Path) -> Optional[List[str]]:
+        try:
+            slides = orjson.loads(cache_file.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        # Touch on hit so eviction drops least recently used decks first; if another
+        # request evicted the file since it was read, the bytes in hand are still good
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return slides
+    
+    def _cache_put(self, cache_file: Path, slides: List[str]) -> None:
+        try:
+            cache_file.write_bytes(orjson.dumps(slides))
+            entries = [(f, f.stat()) for f in self.cache_dir.glob("*.json")]
+            total = sum(stat.st_size for _, stat in entries)
+            for f, stat in sorted(entries, key=lambda entry: entry[1].st_mtime):
+                if total <= self.cache_max_bytes:
+                    break
+                f.unlink(missing_ok=True)
+                total -= stat.st_size
+        except OSError as e:
+            print(f"[PDFParser] Failed to update parse cache: {e}")
+    
+    async def _parse_pdf(self, pdf_path: Path) -> Tuple[List[str], bool]:
+        """Extract text from PDF pages; the flag is False if any page's OCR was unavailable"""
         slides = []
+        complete = True
         
         try:
             # Try text extraction first (doesn't require poppler)
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    text = page.extract_text()
-                    
-                    # If text extraction yields little content, try OCR (requires poppler)
-                    if len(text.strip()) < 50:
-                        try:
-                            # Convert page to image and OCR (requires poppler)
-                            images = convert_from_path(pdf_path, first_page=page_num+1, last_page=page_num+1)
-                            if images:
-                                text = pytesseract.image_to_string(images[0])
-                        except Exception as ocr_error:
-                            # OCR failed (likely poppler not installed), use extracted text as-is
-                            pass
-                    
-                    slides.append(text.strip())
+            slides = await asyncio.to_thread(_extract_text, pdf_path)
+            
+            # If text extraction yields little content, try OCR (requires poppler)
+            needs_ocr = [page_num for page_num, text in enumerate(slides) if len(text.strip()) < 50]
+            text_ratio = 1 - len(needs_ocr) / len(slides) if slides else 0.0
+            if needs_ocr and text_ratio > _OCR_SKIP_RATIO:
+                # Mostly-text deck: the short pages are dividers/visuals, OCR would find little more
+                print(
+                    f"[PDFParser] Skipping OCR for {len(needs_ocr)} sparse page(s): "
+                    f"{text_ratio:.0%} of {len(slides)} pages have a text layer"
+                )
+            elif needs_ocr:
+                dpis = [_OCR_DPI if slides[page_num].strip() else _SCAN_DPI for page_num in needs_ocr]
+                ocr_texts = await self._ocr_pages(pdf_path, needs_ocr, dpis)
+                for page_num, text in zip(needs_ocr, ocr_texts):
+                    if text is None:
+                        complete = False
+                    else:
+                        slides[page_num] = text
+            
+            slides = [text.strip() for text in slides]
         
         except Exception as e:
-            # If PyPDF2 fails, try OCR fallback (requires poppler)
+            # If PyMuPDF fails, try OCR fallback (requires poppler)
+            slides = []
             try:
-                images = convert_from_path(pdf_path)
-                for image in images:
-                    text = pytesseract.image_to_string(image)
-                    slides.append(text.strip())
+                # Render to temp files so page bitmaps stay out of the Python heap
+                with tempfile.TemporaryDirectory() as output_folder:
+                    images = await self._render(pdf_path, output_folder, dpi=_SCAN_DPI)
+                    texts = await asyncio.gather(*[self._ocr_image(image) for image in images])
+                slides = [text.strip() for text in texts]
             except Exception as fallback_error:
                 # Check if error is about poppler
                 error_msg = str(fallback_error).lower()
@@ -74,13 +270,64 @@ class PDFParser:
                 else:
                     raise Exception(f"Failed to parse PDF: {str(e)}, {str(fallback_error)}")
         
-        return slides
+        return slides, complete
+    
+    async def _ocr_pages(self, pdf_path: Path, page_nums: List[int], dpis: List[int]) -> List[Optional[str]]:
+        """Render the given PDF pages with MuPDF at the given DPIs and OCR them; None where OCR is unavailable"""
+        try:
+            images = await asyncio.to_thread(_render_pages, pdf_path, page_nums, dpis)
+        except Exception:
+            # MuPDF could not rasterize this file, try poppler instead
+            return await self._ocr_pages_poppler(pdf_path, page_nums, max(dpis))
+        
+        try:
+            return await asyncio.gather(*[self._ocr_image(image) for image in images])
+        except Exception:
+            # OCR failed (likely tesseract not installed), use extracted text as-is
+            return [None] * len(page_nums)
+    
+    async def _ocr_pages_poppler(self, pdf_path: Path, page_nums: List[int], dpi: int) -> List[Optional[str]]:
+        """Render the given PDF pages in one pdftoppm pass and OCR them; None where OCR is unavailable"""
+        first, last = min(page_nums), max(page_nums)
+        try:
+            # Convert the covering page range to images once and OCR (requires poppler)
+            with tempfile.TemporaryDirectory() as output_folder:
+                images = await self._render(
+                    pdf_path, output_folder, dpi=dpi, first_page=first+1, last_page=last+1
+                )
+                async def ocr(page_num: int) -> Optional[str]:
+                    index = page_num - first
+                    if index >= len(images):
+                        return None
+                    return await self._ocr_image(images[index])
+                return await asyncio.gather(*[ocr(page_num) for page_num in page_nums])
+        except Exception:
+            # OCR failed (likely poppler not installed), use extracted text as-is
+            return [None] * len(page_nums)
+    
+    async def _render(self, pdf_path: Path, output_folder: str, **options) -> List[str]:
+        """Rasterize PDF pages to grayscale images in output_folder; returns the image paths"""
+        # pdftoppm already runs as a subprocess writing straight to disk, so a
+        # thread only waits on it and nothing large comes back into this process
+        return await asyncio.to_thread(
+            convert_from_path,
+            pdf_path,
+            thread_count=_RENDER_THREADS,
+            output_folder=output_folder,
+            paths_only=True,
+            grayscale=True,
+            **options
+        )
+    
+    async def _ocr_image(self, image: Union[Image.Image, str]) -> str:
+        """Run tesseract on an image (or image file path) in the OCR thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_ocr_pool(), _image_to_string, image)
     
     async def _parse_image(self, image_path: Path) -> List[str]:
         """Extract text from image using OCR"""
         try:
-            image = Image.open(image_path)
-            text = pytesseract.image_to_string(image)
+            text = await self._ocr_image(str(image_path))
             return [text.strip()]
         except Exception as e:
             raise Exception(f"Failed to parse image: {str(e)}")
@@ -1,63 +1,332 @@
-from typing import List, Dict, Any, Optional
-import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, Union
+import copy
+import functools
+import hashlib
 import os
 import re
+import numpy as np
+import orjson
+import tiktoken
 from openai import OpenAI
+from .embedding_service import EmbeddingService
+
+_MODEL = "gpt-3.5-turbo-0125"
+
+_URL_RE = re.compile(r"http[s]?://\S+")
+_WWW_RE = re.compile(r"www\.\S+")
+_ETAL_RE = re.compile(r"\bet\s+al\.?", re.IGNORECASE)
+_PAREN_RE = re.compile(r"\([^)]*\)")
+_YEAR_RE = re.compile(r"\b(?:19|20)\d{2}\b")
+
+
+def _clean_text(text: str) -> str:
+    if not text:
+        return text
+    text = _URL_RE.sub("", text)
+    text = _WWW_RE.sub("", text)
+    text = _ETAL_RE.sub("", text)
+    text = _PAREN_RE.sub("", text)
+    text = _YEAR_RE.sub("", text)
+    text = " ".join(text.split())
+    return text
+
+
+# Lecture-invariant instructions live in the system message so every request starts
+# with the same token prefix and benefits from provider-side prompt caching.
+_QUIZ_SYSTEM_PROMPT = """You create clear, grounded multiple-choice questions for students. You only use the provided lecture text and never hallucinate.
+
+You are an instructor creating a short quiz based on lecture slides.
+
+TASK:
+Write 4–6 multiple-choice questions that test key concepts from the lecture segment you are given.
+Each question should cover a DIFFERENT topic from the lecture.
+
+For each question:
+- Provide a SHORT topic label (2-4 words) that describes what concept the question tests (e.g., "Risk Score Range", "Data Sources", "Decision Authority")
+- Provide 3–4 answer options
+- Exactly ONE option must be clearly correct based only on the lecture text
+- Other options must be plausible but incorrect
+
+STRICT RULES:
+- Use ONLY facts that appear in the lecture text
+- Do NOT introduce external knowledge
+- Do NOT mention researchers, names, universities, or citations
+- Avoid slide numbers, dates, or reference codes
+- Keep wording simple and clear
+
+Return ONLY a valid JSON object with this exact structure:
+{
+  "questions": [
+    {
+      "topic": "Short Topic Label",
+      "question": "...",
+      "options": ["...", "...", "..."],
+      "correct_index": 1,
+      "explanation": "1–2 sentence explanation grounded in the lecture text."
+    },
+    ...
+  ]
+}
+"""
+
+_SINGLE_QUESTION_SYSTEM_PROMPT = """You create diverse quiz questions grounded in lecture content. You ensure each question covers a different topic.
+
+You are an instructor creating a quiz question based on lecture slides.
+
+TASK:
+Write exactly 1 multiple-choice question testing a key concept from the lecture text you are given.
+
+CRITICAL REQUIREMENTS:
+- Choose a topic/concept that is DIFFERENT from any previous questions
+- Cover a different part of the lecture material
+- Provide a short topic label (2-4 words) describing what the question tests
+- Provide 3-4 answer options
+- Exactly ONE option must be correct based on the lecture
+- Include a 1-2 sentence explanation
+
+STRICT RULES:
+- Use ONLY facts from the lecture text
+- No external knowledge, no names, no citations, no dates
+- Ensure variety: if previous questions were about technical details, ask about concepts, applications, or relationships instead
+
+Return ONLY valid JSON:
+{
+  "topic": "Short Topic Label",
+  "question": "...",
+  "options": ["...", "...", "..."],
+  "correct_index": 0,
+  "explanation": "..."
+}
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding() -> Optional["tiktoken.Encoding"]:
+    """Load the tokenizer on first use; tiktoken may need to download its BPE file"""
+    try:
+        return tiktoken.encoding_for_model(_MODEL)
+    except Exception as e:
+        print(f"[QuizGenerator] Tokenizer unavailable, truncating by characters: {e}")
+        return None
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep whole paragraphs of text up to a token budget, then as much of the next one as fits"""
+    encoding = _get_encoding()
+    if encoding is None:
+        # Roughly 4 characters per token in English text
+        return text[: max_tokens * 4]
+
+    if len(encoding.encode(text, disallowed_special=())) <= max_tokens:
+        return text
+
+    kept: List[str] = []
+    used = 0
+    for paragraph in text.split("\n\n"):
+        # The "\n\n" separator encodes to a single token
+        separator = 1 if kept else 0
+        paragraph_ids = encoding.encode(paragraph, disallowed_special=())
+        if used + separator + len(paragraph_ids) > max_tokens:
+            # Fill the rest of the budget with the start of the overflowing paragraph
+            remaining = max_tokens - used - separator
+            if remaining > 0:
+                kept.append(encoding.decode(paragraph_ids[:remaining]))
+            break
+        kept.append(paragraph)
+        used += separator + len(paragraph_ids)
+    return "\n\n".join(kept)
+
+
+def _concat_slide_text(slide_data: List[Dict[str, Any]]) -> str:
+    texts = [t for s in slide_data if (t := s.get("text"))]
+    return "\n\n".join(texts).strip()
 
 
 class QuizGenerator:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        embedding_service: Optional[EmbeddingService] = None,
+        semantic_cache_dir: Optional[Union[str, Path]] = "cache/quiz",
+        semantic_threshold: float = 0.93,
+        semantic_cache_size: int = 512,
+    ) -> None:
+        """
+        With an embedding_service, generate() results and the first generate_single()
+        question for a deck are also cached semantically: a lecture with the same number
+        of paragraphs whose embedding is within semantic_threshold cosine similarity of
+        an earlier one (i.e. a re-upload of a near-identical deck) reuses its result.
+        The index is persisted under semantic_cache_dir (pass None to keep it in memory only)
+        """
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable is not set")
         self.client = OpenAI(api_key=api_key)
-        self.model = "gpt-3.5-turbo-0125"
+        self.model = _MODEL
+        # Exact-match cache of normalized results keyed by the full request
+        self._response_cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._response_cache_size = 256
+
+        # Semantic cache: row i of the embedding matrix is the lecture (with
+        # _semantic_paragraphs[i] paragraphs) that produced results[i] of _semantic_kinds[i]
+        self.embedding_service = embedding_service
+        self.semantic_threshold = semantic_threshold
+        self._semantic_cache_size = semantic_cache_size
+        self._semantic_embeddings: Optional[np.ndarray] = None
+        self._semantic_paragraphs: Optional[np.ndarray] = None
+        self._semantic_results: List[Any] = []
+        self._semantic_kinds: List[str] = []
+        self._semantic_cache_dir: Optional[Path] = None
+        if embedding_service is not None and semantic_cache_dir:
+            self._semantic_cache_dir = Path(semantic_cache_dir)
+            self._semantic_cache_dir.mkdir(parents=True, exist_ok=True)
+            self._load_semantic_cache()
+
+    def _cache_key(self, system: str, prompt: str, max_tokens: int, temperature: float) -> str:
+        payload = "\x00".join((self.model, system, prompt, str(max_tokens), str(temperature)))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _cache_get(self, key: str) -> Any:
+        cached = self._response_cache.get(key)
+        if cached is None:
+            return None
+        self._response_cache.move_to_end(key)
+        return copy.deepcopy(cached)
+
+    def _cache_put(self, key: str, value: Any) -> None:
+        self._response_cache[key] = copy.deepcopy(value)
+        if len(self._response_cache) > self._response_cache_size:
+            self._response_cache.popitem(last=False)
+
+    def _lecture_embedding(self, lecture_text: str) -> Tuple[Optional[np.ndarray], int]:
+        """Mean paragraph embedding of a lecture plus its paragraph count"""
+        paragraphs = [p for p in lecture_text.split("\n\n") if p.strip()]
+        if self.embedding_service is None or not paragraphs:
+            return None, len(paragraphs)
+        # MiniLM truncates long inputs, so represent the deck by its mean paragraph embedding
+        embeddings = self.embedding_service.embed_batch(paragraphs)
+        return EmbeddingService.normalize(embeddings.mean(axis=0)), len(paragraphs)
+
+    def _semantic_get(self, embedding: Optional[np.ndarray], paragraph_count: int, kind: str) -> Any:
+        if embedding is None or self._semantic_embeddings is None:
+            return None
+        # The mean of a growing deck prefix drifts slowly, so only decks of the same
+        # length (a re-upload, not the same lecture a few slides further on) qualify
+        candidates = (self._semantic_paragraphs == paragraph_count) & (np.array(self._semantic_kinds) == kind)
+        if not candidates.any():
+            return None
+        similarities = np.where(candidates, self._semantic_embeddings @ embedding, -1.0)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_threshold:
+            return None
+        return copy.deepcopy(self._semantic_results[best])
+
+    def _semantic_put(self, embedding: Optional[np.ndarray], paragraph_count: int, kind: str, value: Any) -> None:
+        if embedding is None:
+            return
+        if self._semantic_embeddings is None:
+            matrix = embedding[None, :]
+            paragraphs = np.array([paragraph_count])
+        else:
+            matrix = np.vstack([self._semantic_embeddings, embedding])
+            paragraphs = np.append(self._semantic_paragraphs, paragraph_count)
+        self._semantic_results.append(copy.deepcopy(value))
+        self._semantic_kinds.append(kind)
+        if len(self._semantic_results) > self._semantic_cache_size:
+            matrix = matrix[-self._semantic_cache_size:]
+            paragraphs = paragraphs[-self._semantic_cache_size:]
+            del self._semantic_results[:-self._semantic_cache_size]
+            del self._semantic_kinds[:-self._semantic_cache_size]
+        self._semantic_embeddings = matrix
+        self._semantic_paragraphs = paragraphs
+        self._save_semantic_cache()
+
+    def _load_semantic_cache(self) -> None:
+        embeddings_path = self._semantic_cache_dir / "quiz.npy"
+        entries_path = self._semantic_cache_dir / "quiz.json"
+        if not (embeddings_path.exists() and entries_path.exists()):
+            return
+        try:
+            matrix = np.load(embeddings_path)
+            entries = orjson.loads(entries_path.read_bytes())
+            paragraphs = np.array([entry["paragraphs"] for entry in entries])
+            results = [entry["questions"] for entry in entries]
+            kinds = [entry.get("kind", "quiz") for entry in entries]
+        except Exception as e:
+            print(f"[QuizGenerator] Ignoring unreadable semantic cache: {e}")
+            return
+        # Rows written by a different embedding model are not comparable
+        if matrix.ndim == 2 and len(matrix) == len(results) and matrix.shape[1] == self.embedding_service.embedding_dim:
+            self._semantic_embeddings = matrix
+            self._semantic_paragraphs = paragraphs
+            self._semantic_results = results
+            self._semantic_kinds = kinds
+
+    def _save_semantic_cache(self) -> None:
+        if self._semantic_cache_dir is None:
+            return
+        entries = [
+            {"kind": kind, "paragraphs": int(count), "questions": questions}
+            for kind, count, questions in zip(
+                self._semantic_kinds, self._semantic_paragraphs, self._semantic_results
+            )
+        ]
+        try:
+            np.save(self._semantic_cache_dir / "quiz.npy", self._semantic_embeddings)
+            (self._semantic_cache_dir / "quiz.json").write_bytes(orjson.dumps(entries))
+        except Exception as e:
+            print(f"[QuizGenerator] Failed to persist semantic cache: {e}")
+
+    def _complete(self, system: str, prompt: str, max_tokens: int, temperature: float) -> str:
+        # Stream so tokens are read off the socket as they arrive rather than in one final payload
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            response_format={"type": "json_object"},
+        )
+        parts: List[str] = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+        return "".join(parts).strip()
 
     def generate(self, notes_text: str, slide_data: List[Dict[str, Any]]) -> List[Dict]:
         if not slide_data:
             return []
 
-        lecture_text = "\n\n".join(
-            s.get("text", "") for s in slide_data if s.get("text")
-        ).strip()
+        lecture_text = _concat_slide_text(slide_data)
         if not lecture_text:
             return []
 
         try:
             prompt = self._build_prompt(notes_text, lecture_text)
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You create clear, grounded multiple-choice questions for students. "
-                            "You only use the provided lecture text and never hallucinate."
-                        ),
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=1100,
-                temperature=0.4,
-            )
-            content = (response.choices[0].message.content or "").strip()
-
-            cleaned = re.sub(r"^```json\s*", "", content)
-            cleaned = re.sub(r"^```", "", cleaned)
-            cleaned = re.sub(r"```$", "", cleaned).strip()
-
-            try:
-                data = json.loads(cleaned)
-            except Exception:
-                start = cleaned.find("[")
-                end = cleaned.rfind("]")
-                if start != -1 and end != -1 and end > start:
-                    snippet = cleaned[start : end + 1]
-                    data = json.loads(snippet)
-                else:
-                    raise
-
-            return self._normalize_questions(data)
+            system = _QUIZ_SYSTEM_PROMPT
+            cache_key = self._cache_key(system, prompt, 1100, 0.4)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached
+
+            lecture_embedding, paragraph_count = self._lecture_embedding(lecture_text)
+            cached = self._semantic_get(lecture_embedding, paragraph_count, "quiz")
+            if cached is not None:
+                return cached
+
+            content = self._complete(system, prompt, max_tokens=1100, temperature=0.4)
+
+            data = orjson.loads(content).get("questions", [])
+
+            questions = self._normalize_questions(data)
+            if questions:
+                self._cache_put(cache_key, questions)
+                self._semantic_put(lecture_embedding, paragraph_count, "quiz", questions)
+            return questions
         except Exception as e:
             print(f"[QuizGenerator] Failed to generate quiz: {e}")
             return []
@@ -70,9 +339,7 @@ class QuizGenerator:
         if not slide_data:
             return {}
 
-        lecture_text = "\n\n".join(
-            s.get("text", "") for s in slide_data if s.get("text")
-        ).strip()
+        lecture_text = _concat_slide_text(slide_data)
         if not lecture_text:
             return {}
 
@@ -84,7 +351,7 @@ class QuizGenerator:
             if topics_covered:
                 exclude_instruction = f"""
 IMPORTANT: Do NOT ask about these topics that were already covered:
-{', '.join(set(topics_covered))}
+{', '.join(sorted(set(topics_covered)))}
 
 Also avoid questions similar to these already asked:
 {chr(10).join(f"- {q}" for q in questions_asked[:3])}
@@ -93,105 +360,46 @@ Choose a DIFFERENT topic and concept from the lecture that hasn't been asked abo
 """
 
         try:
-            prompt = f"""You are an instructor creating a quiz question based on lecture slides.
-
-LECTURE TEXT (only source of truth):
-{lecture_text[:3000]}
-{exclude_instruction}
-TASK:
-Write exactly 1 multiple-choice question testing a key concept from this lecture.
-
-CRITICAL REQUIREMENTS:
-- Choose a topic/concept that is DIFFERENT from any previous questions
-- Cover a different part of the lecture material
-- Provide a short topic label (2-4 words) describing what the question tests
-- Provide 3-4 answer options
-- Exactly ONE option must be correct based on the lecture
-- Include a 1-2 sentence explanation
-
-STRICT RULES:
-- Use ONLY facts from the lecture text
-- No external knowledge, no names, no citations, no dates
-- Ensure variety: if previous questions were about technical details, ask about concepts, applications, or relationships instead
-
-Return ONLY valid JSON:
-{{
-  "topic": "Short Topic Label",
-  "question": "...",
-  "options": ["...", "...", "..."],
-  "correct_index": 0,
-  "explanation": "..."
-}}
-"""
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You create diverse quiz questions grounded in lecture content. You ensure each question covers a different topic."},
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=400,
-                temperature=0.7,
-            )
-            content = (response.choices[0].message.content or "").strip()
+            # Lecture text leads the user message so follow-ups on the same deck share a prefix
+            prompt = f"""LECTURE TEXT (only source of truth):
+{_truncate_to_tokens(lecture_text, 2000)}
+{exclude_instruction}"""
+            system = _SINGLE_QUESTION_SYSTEM_PROMPT
+            # Follow-up questions must differ from earlier ones, so only the first question is cached
+            cache_key = None if previous_questions else self._cache_key(system, prompt, 400, 0.7)
+            lecture_embedding, paragraph_count = None, 0
+            if cache_key is not None:
+                cached = self._cache_get(cache_key)
+                if cached is not None:
+                    return cached
+                lecture_embedding, paragraph_count = self._lecture_embedding(lecture_text)
+                cached = self._semantic_get(lecture_embedding, paragraph_count, "single")
+                if cached is not None:
+                    self._cache_put(cache_key, cached)
+                    return cached
+
+            content = self._complete(system, prompt, max_tokens=400, temperature=0.7)
             
-            cleaned = re.sub(r"^```json\s*", "", content)
-            cleaned = re.sub(r"^```", "", cleaned)
-            cleaned = re.sub(r"```$", "", cleaned).strip()
-            
-            try:
-                data = json.loads(cleaned)
-            except Exception:
-                start = cleaned.find("{")
-                end = cleaned.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    data = json.loads(cleaned[start:end+1])
-                else:
-                    return {}
+            data = orjson.loads(content)
             
             normalized = self._normalize_questions([data])
-            return normalized[0] if normalized else {}
+            if not normalized:
+                return {}
+            if cache_key is not None:
+                self._cache_put(cache_key, normalized[0])
+                self._semantic_put(lecture_embedding, paragraph_count, "single", normalized[0])
+            return normalized[0]
             
         except Exception as e:
             print(f"[QuizGenerator] Failed to generate single question: {e}")
             return {}
 
     def _build_prompt(self, notes_text: str, lecture_text: str) -> str:
-        return f"""You are an instructor creating a short quiz based on lecture slides.
-
-LECTURE TEXT (only source of truth):
-{lecture_text[:3500]}
+        return f"""LECTURE TEXT (only source of truth):
+{_truncate_to_tokens(lecture_text, 2500)}
 
 STUDENT NOTES (may be incomplete):
 {(notes_text or '')[:800]}
-
-TASK:
-Write 4–6 multiple-choice questions that test key concepts from this lecture segment.
-Each question should cover a DIFFERENT topic from the lecture.
-
-For each question:
-- Provide a SHORT topic label (2-4 words) that describes what concept the question tests (e.g., "Risk Score Range", "Data Sources", "Decision Authority")
-- Provide 3–4 answer options
-- Exactly ONE option must be clearly correct based only on the lecture text
-- Other options must be plausible but incorrect
-
-STRICT RULES:
-- Use ONLY facts that appear in the lecture text above
-- Do NOT introduce external knowledge
-- Do NOT mention researchers, names, universities, or citations
-- Avoid slide numbers, dates, or reference codes
-- Keep wording simple and clear
-
-Return ONLY valid JSON with this exact structure:
-[
-  {{
-    "topic": "Short Topic Label",
-    "question": "...",
-    "options": ["...", "...", "..."],
-    "correct_index": 1,
-    "explanation": "1–2 sentence explanation grounded in the lecture text."
-  }},
-  ...
-]
 """
 
     def _normalize_questions(self, data: Any) -> List[Dict]:
@@ -221,25 +429,17 @@ Return ONLY valid JSON with this exact structure:
             if not (0 <= correct_idx < len(options)):
                 continue
 
-            def clean_text(text: str) -> str:
-                text = re.sub(r"http[s]?://\S+", "", text)
-                text = re.sub(r"www\.\S+", "", text)
-                text = re.sub(r"\bet\s+al\.?", "", text, flags=re.IGNORECASE)
-                text = re.sub(r"\([^)]*\)", "", text)
-                text = re.sub(r"\b(?:19|20)\d{2}\b", "", text)
-                text = " ".join(text.split())
-                return text
-
-            topic = clean_text(topic) if topic else "General"
-            q_text = clean_text(q_text)
-            options = [clean_text(o) for o in options]
-            explanation = clean_text(explanation)
+            topic = _clean_text(topic) if topic else "General"
+            q_text = _clean_text(q_text)
+            options = [_clean_text(o) for o in options]
+            explanation = _clean_text(explanation)
 
             if not q_text or any(not o for o in options):
                 continue
 
-            if len(explanation.split()) > 40:
-                explanation = " ".join(explanation.split()[:40]) + "…"
+            words = explanation.split()
+            if len(words) > 40:
+                explanation = " ".join(words[:40]) + "…"
 
             questions.append(
                 {